@@ -1,101 +1,358 @@
 import os
+import re
 import json
+import time
+import random
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import httplib2
 import pytz
 import requests
-from bs4 import BeautifulSoup
+import google_auth_httplib2
+from bs4 import BeautifulSoup, SoupStrainer
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
-import hashlib
+from googleapiclient.errors import HttpError
 
 # CONFIG
 TIMEZONE = "America/Los_Angeles"
 CALENDAR_ID = "primary"  # or your shared calendar ID
 EVENT_LOOKAHEAD_DAYS = 365
+EVENTS_URL = "https://www.theuctheatre.org/events"
 USER_AGENT = "uct-scraper/1.0 (+https://github.com/yourrepo)"
+BATCH_SIZE = 50  # Calendar API requests per batch HTTP call
+MAX_WORKERS = 4  # batches in flight at once; more mostly trips Calendar rate limits
+MAX_RETRIES = 5  # backoff rounds for rate-limited writes (1s, 2s, 4s, ... plus jitter)
+STATE_FILE = os.environ.get("UCT_STATE_FILE", ".uct_sync_state.json")  # page cache, sync token, uid index
 tz = pytz.timezone(TIMEZONE)
+# Keep-alive session; requests already asks for gzip/deflate (and br when brotli is installed)
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": USER_AGENT})
+# Only the event cards are read, so skip building the rest of the page
+EVENT_CARDS = SoupStrainer("div", class_="event-card")
+CARDS_VERSION = 1  # bump whenever scrape_cards() output changes, to drop cached cards
 
-def fetch_events():
-    html = requests.get("https://www.theuctheatre.org/events", headers={"User-Agent": USER_AGENT}).text
-    soup = BeautifulSoup(html, "html.parser")
-    events = []
+# Date/time patterns used to read the event cards, compiled once at import
+MONTHS = {"JAN": 1, "FEB": 2, "MAR": 3, "APR": 4, "MAY": 5, "JUN": 6,
+          "JUL": 7, "AUG": 8, "SEP": 9, "OCT": 10, "NOV": 11, "DEC": 12}
+# Month, day, optional year and optional show time in one pass over "<date>\n<time>".
+# Nothing before the newline may cross it, so the time only ever comes from the time text.
+EVENT_RE = re.compile(
+    r"\b(?P<month>Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*\.?[^\S\n]+(?P<day>[0-3]?\d)(?!\d)"
+    r"(?:\w*,?[^\S\n]+(?P<year>20[2-9]\d)\b)?"
+    r".*\n"
+    r"(?:.*?\b(?P<hour>[0-1]?\d)(?::(?P<minute>[0-5]\d))?\s*(?P<ampm>am|pm))?",
+    re.IGNORECASE,
+)
+
+def parse_start(date_text, time_text, today):
+    """Parse card text like 'Wed, Oct 15' + '8:00 PM' into (naive datetime, all_day).
+
+    all_day is set when the date reads but there's no show time; returns
+    None when the date or a show time that is there can't be read.
+    """
+    m = EVENT_RE.search(f"{' '.join(date_text.split())}\n{' '.join(time_text.split())}")
+    if not m:
+        return None
+
+    # The listing rarely prints a year; assume the next occurrence of the date
+    month_num = MONTHS[m.group("month").upper()]
+    day_num = int(m.group("day"))
+    # 12-hour clock straight to ints, no strptime needed
+    all_day = m.group("hour") is None
+    hour = 0 if all_day else int(m.group("hour"))
+    minute = int(m.group("minute") or 0)
+    if not all_day:
+        if not 1 <= hour <= 12:
+            return None
+        hour = hour % 12 + (12 if m.group("ampm").lower() == "pm" else 0)
+    try:
+        if m.group("year"):
+            return datetime(int(m.group("year")), month_num, day_num, hour, minute), all_day
+        start = datetime(today.year, month_num, day_num, hour, minute)
+        if (today - start.date()).days > 31:
+            start = start.replace(year=today.year + 1)
+        return start, all_day
+    except ValueError:
+        return None
+
+def make_uid(title, start):
+    # Only a dedup key, so a short blake2b digest is plenty and cheaper than SHA-1
+    return hashlib.blake2b(f"{title}{start}".encode(), digest_size=10).hexdigest()
+
+def scrape_cards(html):
+    """Pull the raw text fields off each event card."""
+    soup = BeautifulSoup(html, "lxml", parse_only=EVENT_CARDS)
+    cards = []
 
     for event_block in soup.select("div.event-card"):
         try:
             title = event_block.select_one("h3").get_text(strip=True)
             date_text = event_block.select_one(".event-date").get_text(strip=True)
             times = [t.get_text(strip=True) for t in event_block.select(".event-time")]
-            url = event_block.select_one("a.event-link")["href"] if event_block.select_one("a.event-link") else ""
-            doors = event_block.select_one(".doors").get_text(strip=True) if event_block.select_one(".doors") else ""
-
-            for time_text in times:
-                dt_str = f"{date_text} {time_text}"
-                try:
-                    dt_start = datetime.strptime(dt_str, "%a, %b %d %I:%M %p")
-                    dt_start = tz.localize(dt_start)
-                except Exception:
-                    dt_start = tz.localize(datetime.now().replace(hour=19, minute=0))
-                dt_end = dt_start + timedelta(hours=2)
-
-                description = f"Doors: {doors}\nURL: {url}"
-                # Use a consistent UID based on title + start time
-                uid = hashlib.sha1(f"{title}{dt_start}".encode()).hexdigest()
-                events.append({"uid": uid, "title": title, "start": dt_start, "end": dt_end, "description": description})
+            # Look each optional node up once per card
+            link = event_block.select_one("a.event-link")
+            url = link["href"] if link else ""
+            doors_node = event_block.select_one(".doors")
+            doors = doors_node.get_text(strip=True) if doors_node else ""
+            description = f"Doors: {doors}\nURL: {url}"
+            cards.append({"title": title, "date": date_text, "times": times, "description": description})
         except Exception:
             continue
+    return cards
+
+def fetch_cards(state):
+    """Scrape the events page, reusing the cards cached in state while it's unchanged.
+
+    Only the raw card text is cached; dates are resolved fresh every run.
+    """
+    page = state.get("page", {})
+    if page.get("version") != CARDS_VERSION:
+        page = {}
+    headers = {}
+    if "cards" in page:
+        if page.get("etag"):
+            headers["If-None-Match"] = page["etag"]
+        if page.get("last_modified"):
+            headers["If-Modified-Since"] = page["last_modified"]
+    resp = SESSION.get(EVENTS_URL, headers=headers, timeout=30)
+    if resp.status_code == 304 and "cards" in page:
+        return page["cards"]
+    resp.raise_for_status()
+
+    cards = scrape_cards(resp.content)
+    state["page"] = {
+        "version": CARDS_VERSION,
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+        "cards": cards,
+    }
+    return cards
+
+def fetch_events(state):
+    events = []
+    seen = set()
+    # Resolve today in the venue's timezone once, not per card
+    today = datetime.now(tz).date()
+    earliest = today - timedelta(days=1)
+    cutoff = today + timedelta(days=EVENT_LOOKAHEAD_DAYS)
+
+    for card in fetch_cards(state):
+        for time_text in card["times"]:
+            parsed = parse_start(card["date"], time_text, today)
+            # Without a readable date there's no stable uid, so leave the showing out
+            if not parsed:
+                continue
+            start, all_day = parsed
+            # Drop showings outside the lookahead window before localizing and hashing them
+            if not earliest <= start.date() <= cutoff:
+                continue
+            dt_start = start.date() if all_day else tz.localize(start)
+            # Use a consistent UID based on title + start time
+            uid = make_uid(card["title"], dt_start)
+            # The same showing can be listed on more than one card
+            if uid in seen:
+                continue
+            seen.add(uid)
+            dt_end = dt_start + (timedelta(days=1) if all_day else timedelta(hours=2))
+            events.append({"uid": uid, "title": card["title"], "start": dt_start, "end": dt_end,
+                           "description": card["description"], "all_day": all_day})
     return events
 
-def push_to_gcal(events):
+def content_hash(body):
+    return hashlib.blake2b(json.dumps(body, sort_keys=True).encode(), digest_size=10).hexdigest()
+
+def event_body(ev):
+    body = {
+        "summary": ev["title"],
+        "description": ev["description"],
+    }
+    if ev.get("all_day"):
+        body["start"] = {"date": ev["start"].isoformat()}
+        body["end"] = {"date": ev["end"].isoformat()}
+    else:
+        body["start"] = {"dateTime": ev["start"].isoformat(), "timeZone": TIMEZONE}
+        body["end"] = {"dateTime": ev["end"].isoformat(), "timeZone": TIMEZONE}
+    # uct_hash lets later runs skip events whose content hasn't changed
+    body["extendedProperties"] = {"private": {"uct_uid": ev["uid"], "uct_hash": content_hash(body)}}
+    return body
+
+def load_state():
+    try:
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_state(state):
+    with open(STATE_FILE, "w") as f:
+        json.dump(state, f)
+
+def list_events(service, sync_token=None):
+    """Page through events().list(); returns (items, nextSyncToken)."""
+    # Only pull what the uid index needs, in as few pages as the API allows
+    params = {
+        "calendarId": CALENDAR_ID,
+        "maxResults": 2500,
+        "fields": "items(id,status,extendedProperties/private),nextPageToken,nextSyncToken",
+    }
+    if sync_token:
+        params["syncToken"] = sync_token
+    items = []
+    while True:
+        page = service.events().list(**params).execute()
+        items.extend(page.get("items", []))
+        if "nextPageToken" not in page:
+            return items, page.get("nextSyncToken")
+        params["pageToken"] = page["nextPageToken"]
+
+def sync_index(service, state):
+    """Update state's {event id: {uid, hash}} index from the calendar.
+
+    With a stored sync token only events changed since the last run are
+    listed; without one (or once Google expires it) everything is relisted.
+    """
+    index = state.get("events", {})
+    items = None
+    if state.get("sync_token"):
+        try:
+            items, sync_token = list_events(service, state["sync_token"])
+        except HttpError as e:
+            # 410 Gone means the token expired
+            if e.resp.status != 410:
+                raise
+    if items is None:
+        index = {}
+        items, sync_token = list_events(service)
+
+    for item in items:
+        private = item.get("extendedProperties", {}).get("private", {})
+        # Deleted events come back as just {id, status: cancelled}
+        if item.get("status") == "cancelled" or "uct_uid" not in private:
+            index.pop(item["id"], None)
+        else:
+            index[item["id"]] = {"uid": private["uct_uid"], "hash": private.get("uct_hash")}
+
+    state["sync_token"] = sync_token
+    state["events"] = index
+    return index
+
+def load_credentials():
     sa_info = json.loads(os.environ["GOOGLE_SERVICE_ACCOUNT_JSON"])
-    credentials = service_account.Credentials.from_service_account_info(
+    return service_account.Credentials.from_service_account_info(
         sa_info,
         scopes=["https://www.googleapis.com/auth/calendar"]
     )
-    service = build("calendar", "v3", credentials=credentials)
 
-    # Fetch existing events in next EVENT_LOOKAHEAD_DAYS
-    now = datetime.utcnow().isoformat() + "Z"
-    future = (datetime.utcnow() + timedelta(days=EVENT_LOOKAHEAD_DAYS)).isoformat() + "Z"
-    existing = service.events().list(calendarId=CALENDAR_ID, timeMin=now, timeMax=future).execute()
-    existing_by_uid = {ev.get("id"): ev for ev in existing.get("items", [])}
+def authorized_http(credentials):
+    # Keep-alive connection reused by every call made through it
+    return google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=60))
+
+def push_to_gcal(events, state):
+    credentials = load_credentials()
+    service = build("calendar", "v3", http=authorized_http(credentials), cache_discovery=False)
+
+    index = sync_index(service, state)
+    # Saved before writing: our own inserts show up in the next incremental list
+    save_state(state)
 
     # Create a map to match by UID (we store UID in extendedProperties)
-    uid_to_event_id = {}
-    for ev in existing.get("items", []):
-        uids = ev.get("extendedProperties", {}).get("private", {})
-        if "uct_uid" in uids:
-            uid_to_event_id[uids["uct_uid"]] = ev["id"]
+    uid_to_event = {meta["uid"]: (event_id, meta["hash"]) for event_id, meta in index.items()}
 
+    pending = []
     for ev in events:
-        if ev["uid"] in uid_to_event_id:
-            # Event exists → update it
-            service.events().update(
-                calendarId=CALENDAR_ID,
-                eventId=uid_to_event_id[ev["uid"]],
-                body={
-                    "summary": ev["title"],
-                    "description": ev["description"],
-                    "start": {"dateTime": ev["start"].isoformat(), "timeZone": TIMEZONE},
-                    "end": {"dateTime": ev["end"].isoformat(), "timeZone": TIMEZONE},
-                    "extendedProperties": {"private": {"uct_uid": ev["uid"]}}
-                }
-            ).execute()
-        else:
-            # Event does not exist → insert new
-            service.events().insert(
-                calendarId=CALENDAR_ID,
-                body={
-                    "summary": ev["title"],
-                    "description": ev["description"],
-                    "start": {"dateTime": ev["start"].isoformat(), "timeZone": TIMEZONE},
-                    "end": {"dateTime": ev["end"].isoformat(), "timeZone": TIMEZONE},
-                    "extendedProperties": {"private": {"uct_uid": ev["uid"]}}
-                }
-            ).execute()
+        body = event_body(ev)
+        existing = uid_to_event.get(ev["uid"])
+        if existing and existing[1] == body["extendedProperties"]["private"]["uct_hash"]:
+            continue
+        pending.append((existing[0] if existing else None, body))
+
+    write_events(service, credentials, pending)
+
+def is_rate_limited(exception):
+    """True for the 403 rateLimitExceeded / 429 errors Calendar returns to bursts of writes."""
+    if not isinstance(exception, HttpError):
+        return False
+    if exception.resp.status == 429:
+        return True
+    if exception.resp.status != 403:
+        return False
+    try:
+        errors = json.loads(exception.content).get("error", {}).get("errors", [])
+    except (TypeError, ValueError, AttributeError):
+        return False
+    return any(e.get("reason") in ("rateLimitExceeded", "userRateLimitExceeded") for e in errors)
+
+def write_events(service, credentials, pending):
+    """Insert/update (event id or None, body) pairs, retrying rate-limited writes with backoff."""
+    # httplib2 isn't thread-safe, so each worker sends its batches on its own connection
+    local = threading.local()
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        for attempt in range(MAX_RETRIES + 1):
+            failures = []
+            retry = []
+
+            def on_response(request_id, response, exception):
+                if exception is None:
+                    return
+                if is_rate_limited(exception):
+                    retry.append(pending[int(request_id)])
+                else:
+                    failures.append(exception)
+
+            def send(job):
+                batch, chunk = job
+                if not hasattr(local, "http"):
+                    local.http = authorized_http(credentials)
+                try:
+                    batch.execute(http=local.http)
+                except HttpError as e:
+                    # The whole batch POST was throttled, so none of its writes went through
+                    if not is_rate_limited(e):
+                        raise
+                    retry.extend(chunk)
+
+            # Send the writes BATCH_SIZE at a time instead of one HTTPS round trip each
+            batches = []
+            for i in range(0, len(pending), BATCH_SIZE):
+                batch = service.new_batch_http_request(callback=on_response)
+                for n in range(i, min(i + BATCH_SIZE, len(pending))):
+                    event_id, body = pending[n]
+                    if event_id:
+                        # Event exists → update it
+                        request = service.events().update(
+                            calendarId=CALENDAR_ID,
+                            eventId=event_id,
+                            body=body
+                        )
+                    else:
+                        # Event does not exist → insert new
+                        request = service.events().insert(
+                            calendarId=CALENDAR_ID,
+                            body=body
+                        )
+                    batch.add(request, request_id=str(n))
+                batches.append((batch, pending[i:i + BATCH_SIZE]))
+
+            list(pool.map(send, batches))
+
+            if failures:
+                raise RuntimeError(f"{len(failures)} calendar writes failed, first: {failures[0]}")
+            if not retry:
+                return
+            pending = retry
+            if attempt < MAX_RETRIES:
+                time.sleep(2 ** attempt + random.random())
+
+    raise RuntimeError(f"{len(pending)} calendar writes still rate limited after {MAX_RETRIES} retries")
 
 def main():
-    events = fetch_events()
-    push_to_gcal(events)
+    state = load_state()
+    events = fetch_events(state)
+    push_to_gcal(events, state)
 
 if __name__ == "__main__":
     main()